@@ -6,3 +6,10 @@ import os
 PROJECT_BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 CONFIG_PATH = os.path.join(PROJECT_BASE_DIR, "config.json")
 CREDS_PATH = os.path.join(PROJECT_BASE_DIR, "credentials.json")
+TOKEN_CACHE_PATH = os.path.join(PROJECT_BASE_DIR, ".token_cache.json")
+
+# How many rows from the top of the sheet to read player data from
+SHEET_MAX_ROWS = 500
+
+# Title of the row above the row where we sum everything up
+SUM_ROW_TITLE = "SUM OF OWED/OWING:"
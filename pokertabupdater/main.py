@@ -1,34 +1,160 @@
 """Contains the main function and other functionality."""
 
-import locale
-import json
-import os
-import sys
-import gspread
-import PySimpleGUI as sg
-from oauth2client.service_account import ServiceAccountCredentials
-from pokertabupdater.constants import CONFIG_PATH, CREDS_PATH
+from __future__ import annotations
+
+import datetime
+import random
+import re
+import time
+import tkinter as tk
+from tkinter import messagebox
+from typing import TYPE_CHECKING, Callable, Optional
+import orjson
+from pokertabupdater.constants import (
+    CONFIG_PATH,
+    CREDS_PATH,
+    SHEET_MAX_ROWS,
+    SUM_ROW_TITLE,
+    TOKEN_CACHE_PATH,
+)
 from pokertabupdater.version import VERSION
 
-
-def get_config_dict() -> dict[str, str]:
-    """Parses the config JSON."""
-    with open(CONFIG_PATH, "r") as f:
-        config = json.load(f)
+# The network libraries are slow to import, so they're only imported
+# when we first need to talk to the sheet
+if TYPE_CHECKING:
+    import google.oauth2.service_account
+    import gspread
+    import requests
+
+# Regexes for a player's entry in a ledger. See parse_ledger for the
+# formats these match. Of the four numbers (buy-in, buy-out, stack, and
+# net) only the net is captured, since it's the only one we use.
+LEDGER_CHROME_RE = re.compile(
+    r"^[^\S\n]*(?P<name>\S.*?)[^\S\n]+@[^\S\n]+\S+"
+    r"(?:[^\S\n]+-?[\d.]+){3}[^\S\n]+(?P<net>-?[\d.]+)[^\S\n]*$",
+    re.MULTILINE,
+)
+LEDGER_FIREFOX_RE = re.compile(
+    r"^[^\S\n]*(?P<name>\S.*?)[^\S\n]+@[^\S\n]+\S+[^\S\n]*\n\s*"
+    r"(?:-?[\d.]+[^\S\n]+){3}(?P<net>-?[\d.]+)[^\S\n]*$",
+    re.MULTILINE,
+)
+
+
+def get_config_dict() -> dict:
+    """Parses the config JSON.
+
+    Besides the sheet key, this may contain the cached sheet index of
+    the row where we sum everything up, under "sumRowIndex".
+    """
+    with open(CONFIG_PATH, "rb") as f:
+        config = orjson.loads(f.read())
 
     return config
 
 
+def write_config_dict(config: dict):
+    """Writes the config JSON."""
+    with open(CONFIG_PATH, "wb") as f:
+        f.write(orjson.dumps(config))
+
+
+def get_token_cache() -> dict:
+    """Parses the token cache JSON, if there is one."""
+    try:
+        with open(TOKEN_CACHE_PATH, "rb") as f:
+            token_cache = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        token_cache = {}
+
+    return token_cache
+
+
+def write_token_cache(token_cache: dict):
+    """Writes the token cache JSON."""
+    with open(TOKEN_CACHE_PATH, "wb") as f:
+        f.write(orjson.dumps(token_cache))
+
+
+def use_orjson_for_requests(session: requests.Session):
+    """Makes a session serialize JSON request bodies with orjson.
+
+    gspread passes request bodies to the session as JSON objects, which
+    requests would otherwise serialize with the (slower) json module.
+    """
+    request = session.request
+
+    def request_with_orjson(*args, **kwargs):
+        body = kwargs.pop("json", None)
+
+        if body is not None:
+            kwargs["data"] = orjson.dumps(body)
+            kwargs["headers"] = {
+                **(kwargs.get("headers") or {}),
+                "Content-Type": "application/json",
+            }
+
+        return request(*args, **kwargs)
+
+    session.request = request_with_orjson
+
+
+def cache_refreshed_tokens(creds: google.oauth2.service_account.Credentials):
+    """Writes the credentials' access token to the token cache on refresh."""
+    refresh = creds.refresh
+
+    def refresh_and_cache(request):
+        refresh(request)
+
+        # The refresh itself worked, so don't fail the request that
+        # triggered it just because we couldn't cache the new token
+        try:
+            write_token_cache(
+                {"accessToken": creds.token, "expiry": creds.expiry.isoformat()}
+            )
+        except OSError:
+            pass
+
+    creds.refresh = refresh_and_cache
+
+
 def get_sheet(sheet_key: str) -> gspread.worksheet.Worksheet:
-    """Gets the main spreadsheet."""
-    creds = ServiceAccountCredentials.from_json_keyfile_name(
+    """Gets the main spreadsheet.
+
+    The access token is cached on disk so that we can skip requesting a
+    new one on later runs. The credentials still refresh the token
+    themselves once it expires.
+    """
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    creds = Credentials.from_service_account_file(
         CREDS_PATH,
-        [
+        scopes=[
             "https://spreadsheets.google.com/feeds",
             "https://www.googleapis.com/auth/drive",
         ],
     )
+
+    # Start off with the cached token if we have one. google-auth
+    # expects expiries as naive UTC datetimes.
+    token_cache = get_token_cache()
+
+    if "accessToken" in token_cache:
+        expiry = datetime.datetime.fromisoformat(token_cache["expiry"])
+
+        if expiry.tzinfo is not None:
+            expiry = expiry.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+        creds.token = token_cache["accessToken"]
+        creds.expiry = expiry
+
+    cache_refreshed_tokens(creds)
+
     client = gspread.authorize(creds)
+    client.session.headers["Connection"] = "Keep-Alive"
+    use_orjson_for_requests(client.session)
+
     sheets = client.open_by_key(sheet_key)
 
     return sheets.get_worksheet(0)
@@ -37,14 +163,8 @@ def get_sheet(sheet_key: str) -> gspread.worksheet.Worksheet:
 def parse_ledger(ledger: str) -> dict[str, float]:
     """Parses a ledger and returns deltas dict."""
 
-    deltas = {}
-
-    # Note that we're going to be very flexible with the user input here
-    lines = [line.strip() for line in filter(len, ledger.splitlines())]
-
-    # Now we'll parse the lines. There are two formats we need to
-    # potentially worry about here. On Firefox, the ledger will be
-    # copy-pasted as
+    # There are two formats we need to potentially worry about here. On
+    # Firefox, the ledger will be copy-pasted as
     #
     # PLAYERNAME POSSIBLY WITH WHITESPACE @ SOMEID
     # BUYIN BUYOUT STACK NET
@@ -57,46 +177,189 @@ def parse_ledger(ledger: str) -> dict[str, float]:
     # Technically for the above string "DETAILS" (which is grabbed from
     # a button element named with that string) is appended to the ID,
     # but we aren't using the IDs so this doesn't really matter.
-    is_firefox_format = len(lines[0].rpartition("@")[-1].split()) == 1
-
-    # Now, depending on the format, we'll group the data differently
-    # when we iterate through it. For Firefox format, we'll group the
-    # lines pairwise; for Chrome format, line-by-line is obviously fine.
-    iter_lines = zip(*[iter(lines)] * 2) if is_firefox_format else lines
-
-    for iter_line in iter_lines:
-        # Parse the line(s)
-        if is_firefox_format:
-            l1, l2 = iter_line
-            player_name_raw = " ".join(l1.split()[:-2])
-            player_data = [float(x) for x in l2.split()]
-        else:
-            l_split = iter_line.split()
-            player_name_raw = " ".join(l_split[:-6])
-            player_data = [float(x) for x in l_split[-4:]]
+    #
+    # We'll try the Chrome format first and fall back to the Firefox
+    # format if nothing matches.
+    matches = list(LEDGER_CHROME_RE.finditer(ledger)) or list(
+        LEDGER_FIREFOX_RE.finditer(ledger)
+    )
+
+    # Make sure every entry got matched, since silently dropping a
+    # player would throw off the tab
+    unmatched_text = ""
+    last_match_end = 0
+
+    for match in matches:
+        unmatched_text += ledger[last_match_end : match.start()]
+        last_match_end = match.end()
+
+    unmatched_text += ledger[last_match_end:]
 
-        player_name = player_name_raw.lower().title()
-        delta = player_data[3]
+    if unmatched_text.strip():
+        raise ValueError(
+            "Couldn't parse ledger entry: %s" % unmatched_text.strip().splitlines()[0]
+        )
+
+    # Note that we're going to be very flexible with the user input here
+    return {
+        " ".join(match["name"].split()).lower().title(): float(match["net"])
+        for match in matches
+    }
+
+
+def call_with_backoff(
+    func,
+    *args,
+    retries: int = 5,
+    on_retry: Optional[Callable[[float], None]] = None,
+    **kwargs,
+):
+    """Calls a gspread function, backing off and retrying on rate limits.
+
+    Rate limited calls (status 429) are retried up to the given number
+    of attempts, with the delay between them doubling each time plus
+    some jitter. Any other API error is raised right away. If given,
+    on_retry is called with the delay (in seconds) before each wait.
+    """
+    from gspread.exceptions import APIError
+
+    delay = 1
+
+    for attempt in range(retries):
+        try:
+            return func(*args, **kwargs)
+        except APIError as e:
+            if e.response.status_code != 429 or attempt == retries - 1:
+                raise
 
-        deltas[player_name] = delta
+        jittered_delay = delay + random.random() / 2
 
-    return deltas
+        if on_retry is not None:
+            on_retry(jittered_delay)
 
+        time.sleep(jittered_delay)
+        delay *= 2
 
-def update_sheet(sheet: gspread.worksheet.Worksheet, deltas_dict: dict[str, float]):
+
+def get_update_cells_request(
+    sheet_id: int,
+    row_sheet_idx: int,
+    col_sheet_idx: int,
+    rows: list[list[dict]],
+    fields: str = "userEnteredValue",
+) -> dict:
+    """Makes an updateCells request for a block of cells.
+
+    The block starts at the given cell (using sheet indices) and each
+    row is a list of CellData dicts.
+    """
+    return {
+        "updateCells": {
+            "rows": [{"values": row} for row in rows],
+            "fields": fields,
+            "start": {
+                "sheetId": sheet_id,
+                "rowIndex": row_sheet_idx - 1,
+                "columnIndex": col_sheet_idx - 1,
+            },
+        }
+    }
+
+
+def update_sheet(
+    sheet: gspread.worksheet.Worksheet,
+    deltas_dict: dict[str, float],
+    config: dict,
+    on_retry: Optional[Callable[[float], None]] = None,
+) -> bool:
     """Updates the spreadsheet with given deltas.
 
+    Returns whether anything was sent to the sheet, which won't be the
+    case if no player's total changes.
+
+    If we get rate limited, on_retry is called with how long we'll wait
+    (in seconds) before trying again.
+
+    The config's cached sum row index is used if it's still right, and
+    is corrected otherwise.
+
     Note that cell indices are start at 1, so *_sheet_idx corresponds to
     this convention.
     """
-    players_col = sheet.col_values(1)
+    from gspread.utils import absolute_range_name
 
-    first_player_idx = next(i for i, j in enumerate(players_col) if j)
-    last_player_idx = (
-        next(i for i, j in enumerate(players_col[first_player_idx:]) if not j)
-        + first_player_idx
-        - 1
-    )
+    # Players who broke even don't change anything, so if that's
+    # everyone there's nothing to send
+    deltas_dict = {player: delta for player, delta in deltas_dict.items() if delta}
+
+    if not deltas_dict:
+        return False
+
+    # Get the players and their current totals in one request, along
+    # with the title row above the cached sum row so we can check that
+    # it's still right. Only the top of the sheet is read, and trailing
+    # empty cells aren't returned.
+    cached_sum_row_sheet_idx = config.get("sumRowIndex")
+
+    # The config can be edited by hand, so ignore a cached index that
+    # couldn't have a title row above it
+    if not isinstance(cached_sum_row_sheet_idx, int) or cached_sum_row_sheet_idx < 2:
+        cached_sum_row_sheet_idx = None
+
+    ranges = [absolute_range_name(sheet.title, "A1:B%d" % SHEET_MAX_ROWS)]
+
+    if cached_sum_row_sheet_idx is not None:
+        ranges.append(
+            absolute_range_name(
+                sheet.title,
+                "%d:%d" % (cached_sum_row_sheet_idx - 1, cached_sum_row_sheet_idx - 1),
+            )
+        )
+
+    value_ranges = sheet.spreadsheet.values_batch_get(
+        ranges=ranges,
+        params={"majorDimension": "COLUMNS", "valueRenderOption": "FORMULA"},
+    )["valueRanges"]
+
+    cols = value_ranges[0].get("values", [[]])
+    players_col = cols[0]
+    totals_col = cols[1] if len(cols) > 1 else []
+
+    # Pad out the totals so they line up with the players
+    totals_col += [""] * (len(players_col) - len(totals_col))
+
+    # Check that the cached sum row is still below its title. Each column
+    # of the title row comes back as its own list.
+    is_cached_sum_row_valid = False
+
+    if cached_sum_row_sheet_idx is not None:
+        title_row_cols = value_ranges[1].get("values", [])
+        is_cached_sum_row_valid = [SUM_ROW_TITLE] in title_row_cols
+
+    # Find the players (the first run of non-empty cells) and the sheet
+    # row of each of them in a single pass
+    first_player_idx = None
+    player_to_row_sheet_idx = {}
+
+    for i, player in enumerate(players_col):
+        if player:
+            if first_player_idx is None:
+                first_player_idx = i
+
+            last_player_idx = i
+            player_to_row_sheet_idx[player] = i + 1
+        elif first_player_idx is not None:
+            break
+    else:
+        # The players ran all the way to the end of what we read, so
+        # there may be more of them below that we didn't see
+        if len(players_col) == SHEET_MAX_ROWS:
+            raise ValueError(
+                "Players run past row %d; increase SHEET_MAX_ROWS" % SHEET_MAX_ROWS
+            )
+
+    if first_player_idx is None:
+        raise ValueError("Couldn't find any players in column A of the sheet")
 
     first_player_sheet_idx = first_player_idx + 1
     last_player_sheet_idx = last_player_idx + 1
@@ -104,114 +367,240 @@ def update_sheet(sheet: gspread.worksheet.Worksheet, deltas_dict: dict[str, floa
     # Where to put a new row if we need to insert one
     new_row_sheet_idx = last_player_sheet_idx + 1
 
+    # All of the row updates get sent in a single batch update
+    batch_requests = []
+    new_rows = []
+
+    currency_format = {"numberFormat": {"type": "CURRENCY"}}
+
     # Update or insert rows
     for player, delta in deltas_dict.items():
         # Find row of existing player or make new row with new player
-        try:
-            row_sheet_idx = players_col.index(player) + 1
-            sheet.update_cell(
-                row_sheet_idx,
-                2,
-                sheet.cell(row_sheet_idx, 2, value_render_option="FORMULA").value
-                + delta,
+        row_sheet_idx = player_to_row_sheet_idx.get(player)
+
+        if row_sheet_idx is not None:
+            batch_requests.append(
+                get_update_cells_request(
+                    sheet.id,
+                    row_sheet_idx,
+                    2,
+                    [
+                        [
+                            {
+                                "userEnteredValue": {
+                                    "numberValue": (totals_col[row_sheet_idx - 1] or 0)
+                                    + delta
+                                }
+                            }
+                        ]
+                    ],
+                )
             )
-        except ValueError:
-            sheet.insert_row(
+        else:
+            new_rows.append(
                 [
-                    player,
-                    locale.currency(delta),
-                    "",
-                    locale.currency(0),
-                    locale.currency(0),
-                    "=B%d+D%d+E%d"
-                    % (new_row_sheet_idx, new_row_sheet_idx, new_row_sheet_idx),
-                ],
-                new_row_sheet_idx,
-                value_input_option="USER_ENTERED",
-            )
-            sheet.format(
-                "B%d:D%d" % (new_row_sheet_idx, new_row_sheet_idx),
-                {"numberFormat": {"type": "CURRENCY"}},
+                    {"userEnteredValue": {"stringValue": player}},
+                    {
+                        "userEnteredValue": {"numberValue": delta},
+                        "userEnteredFormat": currency_format,
+                    },
+                    {"userEnteredFormat": currency_format},
+                    {
+                        "userEnteredValue": {"numberValue": 0},
+                        "userEnteredFormat": currency_format,
+                    },
+                    {
+                        "userEnteredValue": {"numberValue": 0},
+                        "userEnteredFormat": currency_format,
+                    },
+                    {
+                        "userEnteredValue": {
+                            "formulaValue": "=B%d+D%d+E%d"
+                            % (new_row_sheet_idx, new_row_sheet_idx, new_row_sheet_idx)
+                        },
+                        "userEnteredFormat": currency_format,
+                    },
+                ]
             )
 
             new_row_sheet_idx += 1
 
+    # Make room for the new players below the existing ones and fill in
+    # their rows. Existing players are all above the inserted rows, so
+    # their updates above aren't affected by the insert.
+    if new_rows:
+        batch_requests.append(
+            {
+                "insertDimension": {
+                    "range": {
+                        "sheetId": sheet.id,
+                        "dimension": "ROWS",
+                        "startIndex": last_player_idx + 1,
+                        "endIndex": new_row_sheet_idx - 1,
+                    },
+                    "inheritFromBefore": False,
+                }
+            }
+        )
+        batch_requests.append(
+            get_update_cells_request(
+                sheet.id,
+                last_player_sheet_idx + 1,
+                1,
+                new_rows,
+                fields="userEnteredValue,userEnteredFormat.numberFormat",
+            )
+        )
+
     # Sort all the data
-    sheet.sort(
-        (2, "des"), range="A%d:E%d" % (first_player_sheet_idx, new_row_sheet_idx - 1)
+    batch_requests.append(
+        {
+            "sortRange": {
+                "range": {
+                    "sheetId": sheet.id,
+                    "startRowIndex": first_player_idx,
+                    "endRowIndex": new_row_sheet_idx - 1,
+                    "startColumnIndex": 0,
+                    "endColumnIndex": 5,
+                },
+                "sortSpecs": [{"dimensionIndex": 1, "sortOrder": "DESCENDING"}],
+            }
+        }
     )
 
     # Update the row where we sum everything up if we need to
-    if last_player_sheet_idx == new_row_sheet_idx - 1:
-        return
+    if new_rows:
+        last_player_sheet_idx = new_row_sheet_idx - 1
+
+        # Use the cached sum row if it's valid; otherwise find the row
+        # below the title "SUM OF OWED/OWING". Either way, it gets moved
+        # down by the rows we're inserting.
+        if is_cached_sum_row_valid:
+            sum_row_sheet_idx = cached_sum_row_sheet_idx + len(new_rows)
+        else:
+            sum_row_sheet_idx = sheet.find(SUM_ROW_TITLE).row + 1 + len(new_rows)
 
-    last_player_sheet_idx = new_row_sheet_idx - 1
+        batch_requests.append(
+            get_update_cells_request(
+                sheet.id,
+                sum_row_sheet_idx,
+                3,
+                [
+                    [
+                        {
+                            "userEnteredValue": {
+                                "formulaValue": "=SUM(%s%d:%s%d)"
+                                % (
+                                    col_letter,
+                                    first_player_sheet_idx,
+                                    col_letter,
+                                    last_player_sheet_idx,
+                                )
+                            }
+                        }
+                        for col_letter in ["B", "D", "E", "F"]
+                    ]
+                ],
+            )
+        )
 
-    # Find the row where we have the title "SUM OF OWED/OWING"
-    sum_row_sheet_idx = sheet.find("SUM OF OWED/OWING:").row + 1
+    call_with_backoff(
+        sheet.spreadsheet.batch_update, {"requests": batch_requests}, on_retry=on_retry
+    )
 
-    # Get the cells we need to update
-    sum_cells = sheet.range(sum_row_sheet_idx, 3, sum_row_sheet_idx, 6)
+    # Cache where the sum row is now. The sheet's already been updated
+    # at this point, and the cache is only there to save a request, so
+    # failing to write it isn't worth reporting.
+    if new_rows:
+        config["sumRowIndex"] = sum_row_sheet_idx
 
-    for i, col_letter in enumerate(["B", "D", "E", "F"]):
-        sum_cells[i].value = "=SUM(%s%d:%s%d)" % (
-            col_letter,
-            first_player_sheet_idx,
-            col_letter,
-            last_player_sheet_idx,
-        )
+        try:
+            write_config_dict(config)
+        except OSError:
+            pass
 
-    sheet.update_cells(
-        sum_cells,
-        value_input_option="USER_ENTERED",
-    )
+    return True
 
 
 def main():
     """The main function."""
 
-    # Set locale based on operating system
-    if os.name == "nt":
-        locale_string = "en-US"
-    else:
-        locale_string = "en_US.UTF-8"
+    # Read config JSON
+    config_dict = get_config_dict()
+
+    # We'll only get the sheet once there's something to submit
+    sheet = None
+
+    def show_status(status: str):
+        """Shows a status message, redrawing the window right away."""
+        status_label.config(text=status)
+        window.update_idletasks()
 
-    locale.setlocale(locale.LC_ALL, locale_string)
+    def show_retry_status(delay: float):
+        """Tells the user we're about to wait before retrying."""
+        show_status(
+            "Rate limited by Google Sheets; retrying in %.0f seconds..." % delay
+        )
+
+    def submit(exit_after: bool):
+        """Updates the sheet with the entered ledger."""
+        nonlocal sheet
 
-    # Window title and layout
-    window_title = "Poker tab updater %s" % VERSION
-    layout = [
-        [
-            sg.Text(
-                "Enter the copy-pasted ledger (make sure the names match the ones on the poker tab!)"
+        show_status("Updating the sheet...")
+
+        # Show the user anything that goes wrong, since they'd otherwise
+        # have no way of knowing whether the sheet got updated
+        try:
+            # Get the sheet
+            if sheet is None:
+                sheet = get_sheet(config_dict["sheetKey"])
+
+            # Parse the input and update the sheet
+            deltas = parse_ledger(ledger_text.get("1.0", "end"))
+            is_updated = update_sheet(
+                sheet, deltas, config_dict, on_retry=show_retry_status
             )
-        ],
-        [sg.Multiline("", size=(70, 15))],
-        [sg.Button("Submit"), sg.Button("Submit and exit"), sg.Button("Exit")],
-    ]
+        except Exception as e:
+            show_status("Couldn't update the sheet")
+            messagebox.showerror(
+                "Couldn't update the sheet", "%s: %s" % (type(e).__name__, e)
+            )
+            return
 
-    # Read config JSON
-    config_dict = get_config_dict()
+        # Leave the window open if nothing changed, since the ledger
+        # probably wasn't pasted in properly
+        if not is_updated:
+            show_status("No changes in ledger; the sheet wasn't updated")
+            return
+
+        show_status("Sheet updated")
+
+        if exit_after:
+            window.destroy()
 
     # Make the window
-    window = sg.Window(window_title, layout)
+    window = tk.Tk()
+    window.title("Poker tab updater %s" % VERSION)
 
-    # Get the sheet
-    sheet = get_sheet(config_dict["sheetKey"])
+    tk.Label(
+        window,
+        text="Enter the copy-pasted ledger (make sure the names match the ones on the poker tab!)",
+    ).pack(anchor="w")
 
-    # Persistent window loop
-    while True:
-        # Get the input values
-        event, input_values = window.read()
+    ledger_text = tk.Text(window, width=70, height=15)
+    ledger_text.pack()
 
-        # Exit handling
-        if event in [sg.WIN_CLOSED, "Exit"]:
-            window.close()
-            sys.exit(0)
+    buttons = tk.Frame(window)
+    buttons.pack(anchor="w")
 
-        # Parse the input and update the sheet
-        deltas = parse_ledger(input_values[0])
-        update_sheet(sheet, deltas)
+    tk.Button(buttons, text="Submit", command=lambda: submit(False)).pack(side="left")
+    tk.Button(buttons, text="Submit and exit", command=lambda: submit(True)).pack(
+        side="left"
+    )
+    tk.Button(buttons, text="Exit", command=window.destroy).pack(side="left")
+
+    status_label = tk.Label(window)
+    status_label.pack(anchor="w")
 
-        if event == "Submit and exit":
-            window.close()
+    # Persistent window loop
+    window.mainloop()